@@ -1,13 +1,167 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import itertools
+import logging
 import os
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+
+def _parse_json(response):
+    # orjson is quite a bit faster on the activities list, but it's optional.
+    # On bad JSON fall through so requests raises its usual exception
+    if orjson is not None:
+        try:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            pass
+    return response.json()
 
 
 class StravaCommitUpdater:
+    # Kept low on purpose, Strava only allows 100 requests per 15 minutes
+    MAX_WORKERS = 8
+    MAX_RETRIES = 5
+    # Strava's short-term rate limit resets on every quarter hour
+    RATE_LIMIT_WINDOW = 15 * 60
+    # Refresh a bit before the token expires so in-flight calls don't 401
+    REFRESH_SKEW = 60
+    # Strava caps per_page here and quietly returns less if you ask for more
+    MAX_PER_PAGE = 200
+
     def __init__(self, client_id, client_secret, refresh_token):
         self.client_id = client_id
         self.client_secret = client_secret
         self.refresh_token = refresh_token
         self.access_token = None
+        self.token_expires_at = 0
+        # Kept off the session so the token never goes to whatthecommit
+        self._auth_headers = {}
+        self._token_lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._rate_limited_until = 0
+        self._quota_exhausted = False
+
+        # One pooled session for every call so keep-alive connections (and
+        # their TLS sessions) get reused instead of handshaking per request
+        self.session = requests.Session()
+        # Transient failures get retried inside urllib3 with exponential
+        # backoff. 429s are left to _record_rate_limit, retrying them before
+        # the 15 minute window resets would only burn more of the quota
+        retry = Retry(
+            total=self.MAX_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=[500, 502, 503, 504],
+            # No POST: a refresh whose response got lost may already have
+            # rotated the refresh token, so retrying it would only fail
+            allowed_methods=['GET', 'PUT'],
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            max_retries=retry,
+            pool_connections=4,
+            pool_maxsize=self.MAX_WORKERS
+        )
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def _record_rate_limit(self, response):
+        # Both headers are "15 minute,daily", e.g. 100,1000
+        usage = self._parse_rate_limit(response, 'X-RateLimit-Usage')
+        limit = self._parse_rate_limit(response, 'X-RateLimit-Limit')
+        short_full = bool(usage and limit) and usage[0] >= limit[0]
+        daily_full = bool(usage and limit) and usage[1] >= limit[1]
+
+        # A 429 with room left in the 15 minute window can only be the daily
+        # limit (or something we can't wait out), so don't sleep on it
+        if daily_full or (response.status_code == 429 and usage and limit
+                          and not short_full):
+            with self._rate_lock:
+                if not self._quota_exhausted:
+                    log.error("Strava's daily rate limit is used up")
+                self._quota_exhausted = True
+        elif response.status_code == 429 or short_full:
+            # Strava doesn't send Retry-After, the window resets on the
+            # next quarter hour
+            now = time.time()
+            window = self.RATE_LIMIT_WINDOW
+            with self._rate_lock:
+                self._rate_limited_until = now - now % window + window
+
+    def _parse_rate_limit(self, response, header):
+        try:
+            short, daily = response.headers[header].split(',')[:2]
+            return int(short), int(daily)
+        except (KeyError, ValueError):
+            return None
+
+    def _wait_for_rate_limit(self):
+        with self._rate_lock:
+            if self._quota_exhausted:
+                raise requests.exceptions.RequestException(
+                    "Strava's daily rate limit is used up"
+                )
+            delay = self._rate_limited_until - time.time()
+        if delay > 0:
+            log.warning("Rate limit reached, waiting %.0fs", delay)
+            time.sleep(delay)
+
+    def _send(self, method, url, **kwargs):
+        # A 429 in the 15 minute window gets one more try once the next
+        # window opens
+        for _ in range(2):
+            self._wait_for_rate_limit()
+            response = self.session.request(method, url,
+                                            headers=self._auth_headers,
+                                            **kwargs)
+            self._record_rate_limit(response)
+            if response.status_code != 429:
+                break
+        return response
+
+    def _strava_request(self, method, url, **kwargs):
+        token = self.access_token
+        response = self._send(method, url, **kwargs)
+        if response.status_code == 401:
+            # Token was revoked or expired early, refresh it once and retry
+            self._invalidate_token(token)
+            if self._get_token():
+                response = self._send(method, url, **kwargs)
+        return response
+
+    def _get_token(self):
+        # Only one thread refreshes, the others wait here and reuse its token
+        with self._token_lock:
+            refresh_at = self.token_expires_at - self.REFRESH_SKEW
+            if not self.access_token or time.time() >= refresh_at:
+                if not self.refresh_access_token():
+                    return None
+            return self.access_token
+
+    def _invalidate_token(self, token):
+        with self._token_lock:
+            # Someone else may have already refreshed it in the meantime
+            if self.access_token == token:
+                self.access_token = None
 
     def refresh_access_token(self):
         auth_url = "https://www.strava.com/oauth/token"
@@ -18,102 +172,201 @@ class StravaCommitUpdater:
             'grant_type': 'refresh_token'
         }
 
-        print("Attempting to refresh token...")
+        log.debug("Attempting to refresh token...")
         try:
-            response = requests.post(auth_url, data=payload)
-            print(f"Token refresh response status: {response.status_code}")
+            response = self.session.post(auth_url, data=payload)
+            log.debug("Token refresh response status: %s",
+                      response.status_code)
             response.raise_for_status()
-            token_data = response.json()
+            token_data = _parse_json(response)
             self.access_token = token_data['access_token']
+            self.token_expires_at = token_data['expires_at']
+            # Strava may rotate the refresh token, so hold on to the new one
+            self.refresh_token = token_data.get('refresh_token',
+                                                self.refresh_token)
+            self._auth_headers = {
+                'Authorization': f'Bearer {self.access_token}'
+            }
             return True
         except requests.exceptions.RequestException as e:
-            print(f"Error refreshing token: {e}")
+            log.error("Error refreshing token: %s", e)
             return False
 
-    def get_last_activities(self, count=30):
-        if not self.access_token:
-            if not self.refresh_access_token():
-                return None
+    def get_activities(self, count=30, since=None, activity_type=None):
+        if not self._get_token():
+            return None
 
-        headers = {'Authorization': f'Bearer {self.access_token}'}
+        # Strava can't filter by type, and with 'after' the whole window gets
+        # read anyway, so use the biggest pages Strava allows for both
+        if since or activity_type:
+            per_page = self.MAX_PER_PAGE
+        else:
+            per_page = min(count, self.MAX_PER_PAGE)
+        params = {'per_page': per_page}
+        if since:
+            params['after'] = int(since)
 
+        activities = []
         try:
-            response = requests.get(
-                'https://www.strava.com/api/v3/athlete/activities',
-                headers=headers,
-                params={
-                    'per_page': count  # Get exactly the number we want
-                }
-            )
-            print(f"Activities response status: {response.status_code}")
-            response.raise_for_status()
+            for page in itertools.count(1):
+                response = self._strava_request(
+                    'GET',
+                    'https://www.strava.com/api/v3/athlete/activities',
+                    params={**params, 'page': page}
+                )
+                log.debug("Activities page %s response status: %s",
+                          page, response.status_code)
+                response.raise_for_status()
 
-            activities = response.json()
-            return activities
+                batch = _parse_json(response)
+                if activity_type:
+                    activities.extend(
+                        a for a in batch if a['type'] == activity_type
+                    )
+                else:
+                    activities.extend(batch)
+
+                if len(batch) < per_page:
+                    break
+                # Without 'after' pages come newest first, so stop early
+                if not since and len(activities) >= count:
+                    break
 
         except requests.exceptions.RequestException as e:
-            print(f"Error fetching activities: {e}")
+            log.error("Error fetching activities: %s", e)
             return None
 
+        if since:
+            # With 'after' Strava returns the oldest first, we want the latest
+            activities.sort(key=lambda a: a['start_date'], reverse=True)
+        return activities[:count]
+
     def get_random_commit_message(self):
         try:
-            response = requests.get('https://whatthecommit.com/index.txt')
+            response = self.session.get('https://whatthecommit.com/index.txt')
             response.raise_for_status()
             return response.text.strip()
         except requests.exceptions.RequestException as e:
-            print(f"Error fetching commit message: {e}")
+            log.warning("Error fetching commit message: %s", e)
             return None
 
     def update_activity_title(self, activity_id, new_title):
-        if not self.access_token:
-            if not self.refresh_access_token():
-                return False
+        if not self._get_token():
+            return False
 
-        headers = {'Authorization': f'Bearer {self.access_token}'}
         update_url = f'https://www.strava.com/api/v3/activities/{activity_id}'
 
         try:
-            response = requests.put(
+            response = self._strava_request(
+                'PUT',
                 update_url,
-                headers=headers,
                 data={'name': new_title}
             )
-            print(f"Update response status: {response.status_code}")
+            log.debug("Update response status: %s", response.status_code)
             response.raise_for_status()
+            log.info("Updated activity %s", activity_id)
             return True
         except requests.exceptions.RequestException as e:
-            print(f"Error updating activity {activity_id}: {e}")
+            log.warning("Error updating activity %s: %s", activity_id, e)
             return False
 
-    def update_last_activities(self, count=30):
-        activities = self.get_last_activities(count)
-        if not activities:
-            print("this shouldn't happen but hey you never know")
-            return
+    def update_activities(self, count=30, since=None, activity_type=None):
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            # Commit messages don't depend on the activities at all, so fetch
+            # them as one batch alongside the activity list
+            activities_future = executor.submit(
+                self.get_activities, count, since, activity_type
+            )
+            message_futures = [
+                executor.submit(self.get_random_commit_message)
+                for _ in range(count)
+            ]
 
-        for i, activity in enumerate(activities, 1):
-            commit_message = self.get_random_commit_message()
-            if not commit_message:
-                print("problem with whatthecommit, skipping")
-                continue
+            activities = activities_future.result()
+            if not activities:
+                for future in message_futures:
+                    future.cancel()
+                if activities is None:
+                    log.error("this shouldn't happen but hey you never know")
+                else:
+                    log.info("No activities to update")
+                return
 
-            if not self.update_activity_title(activity['id'], commit_message):
-                print("Fuck.")
+            # Hand out messages as they arrive so each PUT goes out as soon
+            # as there's a title for it
+            pending = deque(activities)
+            futures = []
+            for message_future in as_completed(message_futures):
+                commit_message = message_future.result()
+                if commit_message:
+                    futures.append(executor.submit(
+                        self.update_activity_title,
+                        pending.popleft()['id'],
+                        commit_message
+                    ))
+                if not pending:
+                    break
 
-        print("\nFinished updating activities!")
+            for future in message_futures:
+                future.cancel()
+            for _ in pending:
+                log.warning("problem with whatthecommit, skipping")
+
+            for future in as_completed(futures):
+                if not future.result():
+                    log.warning("Fuck.")
+
+        log.info("Finished updating activities!")
+
+
+# Each mode maps to get_activities filters, built lazily so the time
+# windows are relative to when the script actually runs
+MODES = {
+    'all': lambda args: {},
+    'runs': lambda args: {
+        'activity_type': 'Run',
+        'since': time.time() - args.lookback_days * 24 * 60 * 60
+    },
+    'recent': lambda args: {'since': time.time() - 24 * 60 * 60},
+}
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Rename Strava activities to random commit messages"
+    )
+    parser.add_argument('--mode', choices=MODES, default='all',
+                        help="all activities, runs only or the last day")
+    parser.add_argument('--count', type=positive_int, default=30,
+                        help="how many activities to rename")
+    parser.add_argument('--lookback-days', type=positive_int, default=30,
+                        help="how far back to look for runs in runs mode")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="show progress (-v) or every request (-vv)")
+    args = parser.parse_args()
+
+    levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=levels[min(args.verbose, len(levels) - 1)],
+                        format='%(levelname)s %(message)s')
+
     client_id = os.getenv('STRAVA_CLIENT_ID')
     client_secret = os.getenv('STRAVA_CLIENT_SECRET')
     refresh_token = os.getenv('STRAVA_REFRESH_TOKEN')
 
     if not all([client_id, client_secret, refresh_token]):
-        print("Missing required environment variables!")
+        log.error("Missing required environment variables!")
         return
 
     updater = StravaCommitUpdater(client_id, client_secret, refresh_token)
-    updater.update_last_activities(30)
+    with updater:
+        updater.update_activities(args.count, **MODES[args.mode](args))
 
 
 if __name__ == "__main__":